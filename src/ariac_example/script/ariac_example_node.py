@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
+import threading
+
 import rospy
 from ariac_example import ariac_example
 
@@ -25,6 +28,10 @@ def main():
     ariac_example.connect_callbacks(competition)
     rospy.loginfo("Setup complete.")
 
+    # The simulator is usually launched alongside this node and can be slow to
+    # come up, so allow a generous but finite wait before giving up.
+    if not ariac_example.wait_for_services(timeout=300.0):
+        return
     ariac_example.start_competition()
 
     if not competition.has_been_zeroed:
@@ -32,7 +39,16 @@ def main():
         rospy.loginfo("Sending arm to zero joint positions...")
         competition.send_arm_to_state([0] * len(competition.arm_joint_names))
 
-    rospy.spin()
+    if sys.version_info[0] < 3:
+        # An untimed Event.wait() cannot be interrupted by SIGINT on Python 2,
+        # so keep the polling spin there.
+        rospy.spin()
+        return
+
+    # Block until shutdown without polling; subscriber threads keep running.
+    shutdown_event = threading.Event()
+    rospy.on_shutdown(shutdown_event.set)
+    shutdown_event.wait()
 
 
 if __name__ == '__main__':
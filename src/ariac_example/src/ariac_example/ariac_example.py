@@ -15,39 +15,103 @@
 
 from __future__ import print_function
 
-import time
+import threading
+import traceback
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import rospy
 from sensor_msgs.msg import JointState
 from std_msgs.msg import String
 from std_srvs.srv import Trigger
-from trajectory_msgs.msg import JointTrajectory
-from trajectory_msgs.msg import JointTrajectoryPoint
-from osrf_gear.msg import Order
-from osrf_gear.msg import VacuumGripperState
-from osrf_gear.srv import ConveyorBeltControl
-from osrf_gear.srv import DroneControl
-from osrf_gear.srv import VacuumGripperControl
-
-
-_comp_state_sub = None
-_order_sub = None
-_joint_state_sub = None
-_gripper_state_sub = None
+from trajectory_msgs.msg import JointTrajectory, JointTrajectoryPoint
+from osrf_gear.msg import Order, VacuumGripperState
+from osrf_gear.srv import ConveyorBeltControl, DroneControl, VacuumGripperControl
+
+
+_ARM_JOINT_NAMES = (
+    'iiwa_joint_1',
+    'iiwa_joint_2',
+    'iiwa_joint_3',
+    'iiwa_joint_4',
+    'iiwa_joint_5',
+    'iiwa_joint_6',
+    'iiwa_joint_7',
+    'linear_arm_actuator_joint',
+)
+
+# rospy.Duration is a plain genpy value and does not need an initialized node.
+_ONE_SECOND = rospy.Duration(1.0)
+
+_START_COMPETITION_SERVICE = '/ariac/start_competition'
+_GRIPPER_CONTROL_SERVICE = '/ariac/gripper/control'
+_DRONE_CONTROL_SERVICE = '/ariac/drone'
+_CONVEYOR_CONTROL_SERVICE = '/ariac/conveyor/control'
+_SERVICE_NAMES = (
+    _START_COMPETITION_SERVICE,
+    _GRIPPER_CONTROL_SERVICE,
+    _DRONE_CONTROL_SERVICE,
+    _CONVEYOR_CONTROL_SERVICE,
+)
+
+# Persistent service proxies keyed by service name, created on first use so
+# later calls reuse the same connection. Each entry is a (proxy, lock) pair:
+# a persistent proxy does not serialise calls on its connection and callbacks
+# run on several threads, so calls to one service are guarded by its own lock.
+# _service_lock only guards creating entries, so calls to different services
+# do not wait on each other.
+_service_proxies = {}
+_service_lock = threading.Lock()
+
+
+def _call_service(name, service_class, *args):
+    with _service_lock:
+        entry = _service_proxies.get(name)
+        if entry is None:
+            entry = (rospy.ServiceProxy(name, service_class, persistent=True),
+                     threading.Lock())
+            _service_proxies[name] = entry
+    proxy, lock = entry
+    with lock:
+        try:
+            return proxy(*args)
+        except rospy.ServiceException:
+            # A persistent connection is unusable after a failure; closing it
+            # makes the next call through this proxy reconnect.
+            proxy.close()
+            raise
+
+
+def wait_for_services(timeout=None):
+    """Wait once for every competition service used by this module.
+
+    Call after rospy.init_node() so the control functions below can go
+    straight to their service proxies. Returns False if a service is not
+    available within timeout seconds; None waits indefinitely.
+    """
+    rospy.loginfo("Waiting for competition services to be ready...")
+    try:
+        for name in _SERVICE_NAMES:
+            rospy.wait_for_service(name, timeout=timeout)
+    except rospy.ROSException as exc:
+        rospy.logerr("Failed to wait for competition services: %s" % exc)
+        return False
+    rospy.loginfo("Competition services are now ready.")
+    return True
 
 
 def start_competition():
     
-    name = '/ariac/start_competition'
+    name = _START_COMPETITION_SERVICE
 
-    rospy.loginfo("Waiting for competition to be ready...")
-    rospy.wait_for_service(name)
-    rospy.loginfo("Competition is now ready.")
     rospy.loginfo("Requesting competition start...")
 
     try:
-        start = rospy.ServiceProxy('/ariac/start_competition', Trigger)
-        response = start()
+        response = _call_service(name, Trigger)
     except rospy.ServiceException as exc:
         rospy.logerr("Failed to start the competition: %s" % exc)
         return False
@@ -62,16 +126,12 @@ def start_competition():
 
 def control_gripper(enabled):
 
-    name = '/ariac/gripper/control'
+    name = _GRIPPER_CONTROL_SERVICE
     
-    rospy.loginfo("Waiting for gripper control to be ready...")
-    rospy.wait_for_service(name)
-    rospy.loginfo("Gripper control is now ready.")
     rospy.loginfo("Requesting gripper control...")
 
     try:
-        gripper_control = rospy.ServiceProxy('/ariac/gripper/control', VacuumGripperControl)
-        response = gripper_control(enabled)
+        response = _call_service(name, VacuumGripperControl, enabled)
     except rospy.ServiceException as exc:
         rospy.logerr("Failed to control the gripper: %s" % exc)
         return False
@@ -86,16 +146,12 @@ def control_gripper(enabled):
 
 def control_drone(shipment_type):
     
-    name = '/ariac/drone'
+    name = _DRONE_CONTROL_SERVICE
     
-    rospy.loginfo("Waiting for drone control to be ready...")
-    rospy.wait_for_service(name)
-    rospy.loginfo("Drone control is now ready.")
     rospy.loginfo("Requesting drone control...")
 
     try:
-        drone_control = rospy.ServiceProxy(name, DroneControl)
-        response = drone_control(shipment_type)
+        response = _call_service(name, DroneControl, shipment_type)
     except rospy.ServiceException as exc:
         rospy.logerr("Failed to control the drone: %s" % exc)
         return False
@@ -110,16 +166,12 @@ def control_drone(shipment_type):
 
 def control_conveyor(power):
     
-    name = '/ariac/conveyor/control'
+    name = _CONVEYOR_CONTROL_SERVICE
     
-    rospy.loginfo("Waiting for conveyor control to be ready...")
-    rospy.wait_for_service(name)
-    rospy.loginfo("Conveyor control is now ready.")
     rospy.loginfo("Requesting conveyor control...")
 
     try:
-        conveyor_control = rospy.ServiceProxy(name, ConveyorBeltControl)
-        response = conveyor_control(power)
+        response = _call_service(name, ConveyorBeltControl, power)
     except rospy.ServiceException as exc:
         rospy.logerr("Failed to control the conveyor: %s" % exc)
         return False
@@ -132,72 +184,140 @@ def control_conveyor(power):
     return response.success
 
 
+class _CallbackWorker(object):
+    """Run a message handler on its own thread, fed from a queue that
+    optionally drops the oldest message.
+
+    Subscriber callbacks only enqueue the message, so slow handlers do not
+    hold up the rospy receive thread or other topics. With a maxsize above 0
+    the oldest pending message is dropped when the queue is full; a maxsize
+    of 0 means unbounded and nothing is dropped.
+    """
+
+    def __init__(self, name, handler, maxsize=1):
+        self._handler = handler
+        self._queue = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, msg):
+        while True:
+            try:
+                self._queue.put_nowait(msg)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _run(self):
+        while True:
+            msg = self._queue.get()
+            try:
+                self._handler(msg)
+            except Exception:
+                rospy.logerr("Failed to handle message on %s:\n%s",
+                             self._thread.name, traceback.format_exc())
+
+
 class MyCompetition:
-    def __init__(self):
+    def __init__(self, enable_joint_state=False, enable_gripper_state=False):
+        # The sensor topics are only subscribed to when requested, since
+        # every message costs deserialization and a callback even if unused.
+        self.enable_joint_state = enable_joint_state
+        self.enable_gripper_state = enable_gripper_state
         self.joint_trajectory_publisher = \
-            rospy.Publisher("/ariac/arm/command", JointTrajectory, queue_size=10)
+            rospy.Publisher("/ariac/arm/command", JointTrajectory,
+                            queue_size=1, tcp_nodelay=True, latch=False)
         self.current_comp_state = None
-        self.received_orders = []
+        # Every order is still delivered to order_callback; only the history
+        # kept here is bounded so a long run does not hold every order in
+        # memory. A warning is logged when an old order is evicted.
+        self.received_orders = deque(maxlen=32)
         self.current_joint_state = None
         self.current_gripper_state = None
-        self.last_joint_state_print = time.time()
-        self.last_gripper_state_print = time.time()
         self.has_been_zeroed = False
-        self.arm_joint_names = [
-            'iiwa_joint_1',
-            'iiwa_joint_2',
-            'iiwa_joint_3',
-            'iiwa_joint_4',
-            'iiwa_joint_5',
-            'iiwa_joint_6',
-            'iiwa_joint_7',
-            'linear_arm_actuator_joint'
-        ]
+        # Subscribers created by connect_callbacks, kept here so they stay
+        # alive as long as the competition does.
+        self._subs = []
+        self.arm_joint_names = _ARM_JOINT_NAMES
+        # Arm commands reuse a single trajectory message; only the target
+        # positions change between calls. The lock stops callbacks on other
+        # threads from changing the positions while a command is published.
+        self._traj_lock = threading.Lock()
+        self._traj_point = JointTrajectoryPoint(time_from_start=_ONE_SECOND)
+        self._traj_msg = JointTrajectory(joint_names=self.arm_joint_names)
+        self._traj_msg.points = [self._traj_point]
+        # Sensor states are logged from timers so the subscriber callbacks
+        # only have to store the latest message.
+        if self.enable_joint_state:
+            self._joint_state_log_timer = \
+                rospy.Timer(rospy.Duration(10), self._log_joint_state)
+        if self.enable_gripper_state:
+            self._gripper_state_log_timer = \
+                rospy.Timer(rospy.Duration(10), self._log_gripper_state)
 
     def comp_state_callback(self, msg):
         if self.current_comp_state != msg.data:
-            rospy.loginfo("Competition state: " + str(msg.data))
+            rospy.loginfo("Competition state: %s", msg.data)
         self.current_comp_state = msg.data
 
     def order_callback(self, msg):
-        rospy.loginfo("Received order:\n" + str(msg))
+        rospy.loginfo("Received order:\n%s", msg)
+        if len(self.received_orders) == self.received_orders.maxlen:
+            rospy.logwarn("Dropping oldest received order from history: %s",
+                          self.received_orders[0].order_id)
         self.received_orders.append(msg)
 
     def joint_state_callback(self, msg):
-        if time.time() - self.last_joint_state_print >= 10:
-            rospy.loginfo("Current Joint States (throttled to 0.1 Hz):\n" + str(msg))
-            self.last_joint_state_print = time.time()
         self.current_joint_state = msg
 
     def gripper_state_callback(self, msg):
-        if time.time() - self.last_gripper_state_print >= 10:
-            rospy.loginfo("Current gripper state (throttled to 0.1 Hz):\n" + str(msg))
-            self.last_gripper_state_print = time.time()
         self.current_gripper_state = msg
 
+    def _log_joint_state(self, event):
+        msg = self.current_joint_state
+        if msg is not None:
+            rospy.loginfo("Current Joint States (throttled to 0.1 Hz):\n%s", msg)
+
+    def _log_gripper_state(self, event):
+        msg = self.current_gripper_state
+        if msg is not None:
+            rospy.loginfo("Current gripper state (throttled to 0.1 Hz):\n%s", msg)
+
     def send_arm_to_state(self, positions):
-        msg = JointTrajectory()
-        msg.joint_names = self.arm_joint_names
-        point = JointTrajectoryPoint()
-        point.positions = positions
-        point.time_from_start = rospy.Duration(1.0)
-        msg.points = [point]
-        rospy.loginfo("Sending command:\n" + str(msg))
-        self.joint_trajectory_publisher.publish(msg)
+        with self._traj_lock:
+            self._traj_point.positions = positions
+            rospy.logdebug("Sending command:\n%s", self._traj_msg)
+            self.joint_trajectory_publisher.publish(self._traj_msg)
+
+
+def _subscribe(competition, topic, msg_class, callback, maxsize=1, **kwargs):
+    # The rospy callback only hands the message to the topic's worker thread,
+    # so the receive thread keeps draining the socket while callback runs.
+    worker = _CallbackWorker(topic, callback, maxsize)
+    competition._subs.append(rospy.Subscriber(topic, msg_class, worker.put, **kwargs))
 
 
 def connect_callbacks(competition):
 
-    global _comp_state_sub
-    global _order_sub
-    global _joint_state_sub
-    global _gripper_state_sub
-
-    _comp_state_sub = rospy.Subscriber(
-        "/ariac/competition_state", String, competition.comp_state_callback)
-    _order_sub = rospy.Subscriber(
-        "/ariac/orders", Order, competition.order_callback)
-    _joint_state_sub = rospy.Subscriber(
-        "/ariac/joint_states", JointState, competition.joint_state_callback)
-    _gripper_state_sub = rospy.Subscriber(
-        "/ariac/gripper/state", VacuumGripperState, competition.gripper_state_callback)
+    # Competition state changes and orders must not be lost, so their worker
+    # queues are unbounded.
+    _subscribe(competition, "/ariac/competition_state", String,
+               competition.comp_state_callback, maxsize=0)
+    _subscribe(competition, "/ariac/orders", Order,
+               competition.order_callback, maxsize=0,
+               queue_size=10, tcp_nodelay=True)
+    # Sensor topics are high rate and only the latest message matters, so keep
+    # a single message queued and a receive buffer large enough to drain the
+    # socket on every read instead of falling behind with stale messages.
+    if competition.enable_joint_state:
+        _subscribe(competition, "/ariac/joint_states", JointState,
+                   competition.joint_state_callback,
+                   queue_size=1, buff_size=2**24, tcp_nodelay=True)
+    if competition.enable_gripper_state:
+        _subscribe(competition, "/ariac/gripper/state", VacuumGripperState,
+                   competition.gripper_state_callback,
+                   queue_size=1, buff_size=2**24, tcp_nodelay=True)